@@ -1,7 +1,10 @@
 import argparse
+import io
 import json
 import os
+import uuid
 import requests
+from urllib3.fields import RequestField
 from sys import exit, stderr
 
 
@@ -10,7 +13,7 @@ def handle_args():
 
     parser.add_argument(
         "--auth-token",
-        type=str,
+        type=str.strip,
         required=True,
         help="Authorization token get from Emotech LTD",
     )
@@ -34,32 +37,78 @@ def handle_args():
     return parser.parse_args()
 
 
-def get_response(args):
+class MultipartFile:
+    """
+    A multipart/form-data body holding a single file. The file is read lazily while the request is being sent, so
+    large files are streamed instead of being loaded into memory.
+    """
+
+    def __init__(self, field: str, file, filename: str, content_type: str):
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        # urllib3 escapes quotes and line breaks in the file name, which would otherwise break the part header.
+        part = RequestField(field, b"", filename=filename)
+        part.make_multipart(content_type=content_type)
+        head = ("--%s\r\n" % boundary + part.render_headers()).encode("utf-8")
+        tail = ("\r\n--%s--\r\n" % boundary).encode("utf-8")
+        self._parts = [io.BytesIO(head), file, io.BytesIO(tail)]
+        self._length = len(head) + os.fstat(file.fileno()).st_size + len(tail)
+
+    def __len__(self) -> int:
+        # Used by requests to set Content-Length, so the body is not sent chunked.
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self._parts and size != 0:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+
+def create_session(auth_token: str) -> requests.Session:
+    """
+    Create a session that keeps connections alive, so requests to the same endpoint share one TCP/TLS connection.
+    The authorization header is built once here and sent with every request of the session.
+    """
+    session = requests.Session()
+    session.headers["Authorization"] = "Bearer " + auth_token
+    return session
+
+
+def get_response(args, session: requests.Session):
     URL = args.endpoint
     if args.version:
         url = URL + "/version"
-        return requests.get(url)
+        return session.get(url)
     else:
         path = os.path.expanduser(args.file)
-        if not os.path.exists(path):
+        if not os.path.isfile(path):
             raise FileNotFoundError(path)
 
-        files = {"audio": open(path, "rb")}
-
-        headers = {"Authorization": "Bearer " + args.auth_token.strip()}
-
         if args.language == "auto":
             url = URL + "/assess"
         else:
             url = URL + "/" + args.language + "/assess"
-        return requests.post(url, headers=headers, files=files)
+        with open(path, "rb") as audio:
+            body = MultipartFile(
+                "audio", audio, os.path.basename(path), "application/octet-stream"
+            )
+            headers = {"Content-Type": body.content_type}
+            return session.post(url, headers=headers, data=body)
 
 
 def main():
     # System init.
     args = handle_args()
 
-    response = get_response(args)
+    with create_session(args.auth_token) as session:
+        response = get_response(args, session)
 
     if response.status_code == 200:
         json_ = json.loads(response.text)